@@ -0,0 +1,33 @@
+# backend/gunicorn.conf.py
+# Production server: `cd backend && gunicorn main:app`
+# (`python main.py` remains the development server)
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+
+# --- Workers ---
+# Threaded workers: request time is dominated by LLM calls, and bcrypt/OCR
+# already run on their own pools, so threads cover the concurrency.
+# Per-user caches and the login limiter live in process memory, so extra
+# workers each keep their own copy. Behind a reverse proxy, set PROXY_HOPS so
+# the limiter sees real client IPs.
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+# Every request thread and every background LLM thread (summaries, check-in
+# analyses) may hold a pooled connection per DB; workers inherit this
+os.environ.setdefault('DB_POOL_SIZE', str(threads + int(os.getenv('LLM_WORKERS', 4))))
+
+# Don't preload: the DB pools, write-coalescer thread and executors are built
+# at import and must not be shared across fork. Each worker imports the app
+# itself; schema migrations are already safe to race (see _migrate).
+preload_app = False
+
+# --- Connections ---
+keepalive = 5
+# Above the LLM client's 120s read timeout
+timeout = 180
+graceful_timeout = 30
+
+accesslog = '-'
@@ -1,100 +1,65 @@
 # backend/main.py
 
-import requests
-import json
+import atexit
+import hashlib
+import io
 import os
-import logging
-from dotenv import load_dotenv
-from datetime import datetime, timezone  # ✅ For timezone-aware UTC
-
-# Load environment variables from .env file
-load_dotenv(dotenv_path='../.env') # Assumes .env is in the root, one level up
-
-class LMStudioService:
-    def __init__(self):
-        # Get config from environment variables
-        self.base_url = os.getenv("LM_STUDIO_URL", "http://192.168.96.1:1234")
-        self.model_name = os.getenv("LM_STUDIO_MODEL", "yourmodel") # Change default if needed
-        self.api_endpoint = f"{self.base_url}/v1/chat/completions"
-        logging.info(f"Initializing LMStudioService for model: {self.model_name} at {self.base_url}")
-
-    def call_llm(self, prompt, max_tokens=1000, temperature=0.7):
-        """
-        Calls the LM Studio OpenAI-compatible API.
-        """
-        payload = {
-            "model": self.model_name,
-            "messages": [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "stream": False # Ensure we get a complete response, not a stream
-        }
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        try:
-            response = requests.post(
-                self.api_endpoint,
-                json=payload,
-                headers=headers,
-                timeout=120  # Reduced from 999999 to 120 seconds
-            )
-            
-            # Check for HTTP errors
-            response.raise_for_status()
-            
-            # Parse the JSON response
-            data = response.json()
-            
-            # Extract the content from the response
-            if "choices" in data and len(data["choices"]) > 0:
-                content = data["choices"][0]["message"]["content"]
-                return content.strip()
-            else:
-                logging.error(f"LM Studio API response missing 'choices': {data}")
-                return "Error: Invalid response structure from LLM."
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error calling LM Studio API: {e}")
-            return f"Error: Could not connect to LLM service. {e}"
-        except json.JSONDecodeError:
-            logging.error(f"Failed to decode JSON response: {response.text}")
-            return "Error: Failed to decode LLM response."
-
-
-import os
-import json
 import sqlite3
 import uuid
+import queue
+import threading
+import time
 import logging
-from datetime import datetime, timezone  # ✅ Import timezone
+from datetime import datetime, timedelta, timezone  # ✅ Import timezone
+from contextlib import contextmanager
 from functools import wraps
-from flask import Flask, request, jsonify, session
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from flask import Flask, Response, request, jsonify, session, g, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import bcrypt
+import orjson
 import re
+import zstandard as zstd
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
+from services.ocr_worker import image_to_text, ocr_pdf_page
+
 # --- Import your new LLM service ---
 # (Assumes llm_service.py is in 'backend/services/' directory)
 try:
-    from services.llm_service import LMStudioService
+    from services.llm_service import LMStudioService, LLMStreamError
 except ImportError:
     print("WARNING: 'services.llm_service' not found. LLM endpoints will fail.")
     # Define a mock class so the app can run for testing other routes
+    class LLMStreamError(Exception):
+        pass
+
     class LMStudioService:
         def call_llm(self, prompt, max_tokens=100, temperature=0.1):
             logging.error("Using MOCK LMStudioService. 'services.llm_service' not found.")
-            return json.dumps({"error": "LLM Service not configured"})
+            return orjson.dumps({"error": "LLM Service not configured"}).decode()
+
+        def call_llm_stream(self, prompt, max_tokens=100, temperature=0.1):
+            yield self.call_llm(prompt, max_tokens, temperature)
 
 # --- App, Logging, and Service Initialization ---
+class OrjsonProvider(JSONProvider):
+    """Route jsonify()/request.get_json() through orjson (Rust) instead of stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 load_dotenv()
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 logging.basicConfig(level=logging.INFO)
 
 # Initialize LLM Service
@@ -110,6 +75,14 @@ app.config.update(
     PERMANENT_SESSION_LIFETIME=604800,   # 7 days in seconds
 )
 
+# --- Reverse Proxy ---
+# Number of proxies in front of the app (0 = served directly). Trusting exactly
+# that many X-Forwarded-For hops makes request.remote_addr the real client
+# (the login limiter keys on it) without letting clients spoof the header.
+PROXY_HOPS = int(os.getenv('PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+
 # --- CORS Configuration ---
 CORS(app, 
      supports_credentials=True,
@@ -117,6 +90,20 @@ CORS(app,
      allow_headers=['Content-Type', 'Authorization'],
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
 
+# --- Response Compression ---
+# Brotli/gzip for JSON bodies of 1 KB+ (check-in lists, reports); small
+# replies and SSE streams go out as-is.
+try:
+    from flask_compress import Compress
+    app.config.update(
+        COMPRESS_ALGORITHM=['br', 'gzip'],
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_STREAMS=False,  # compressing would buffer SSE until the end
+    )
+    Compress(app)
+except ImportError:
+    logging.warning("flask-compress not installed; responses are sent uncompressed")
+
 # --- Database Configuration ---
 AUTH_DB_PATH = os.getenv('AUTH_DATABASE_PATH', 'data/auth.db')
 APP_DB_PATH = os.getenv('APP_DATABASE_PATH', 'data/app.db')
@@ -125,105 +112,538 @@ APP_DB_PATH = os.getenv('APP_DATABASE_PATH', 'data/app.db')
 os.makedirs(os.path.dirname(AUTH_DB_PATH), exist_ok=True)
 os.makedirs(os.path.dirname(APP_DB_PATH), exist_ok=True)
 
-# --- Auth DB ---
-def get_auth_db():
-    conn = sqlite3.connect(AUTH_DB_PATH)
+# --- Connection Pools ---
+# Connections are opened once at startup and handed out one per request via
+# flask.g, so handlers no longer pay sqlite3.connect + pragma setup per call.
+# Each request thread and each _LLM_POOL thread can hold one connection per
+# DB, so keep this at least threads + LLM_WORKERS (gunicorn.conf.py sets it)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 20))
+# Per-connection prepared statement LRU (sqlite3 default is 128)
+DB_CACHED_STATEMENTS = 256
+
+# cache_size is per connection but only fills up to the size of the file;
+# reads past it come straight from the 256 MB memory map
+SQLITE_PRAGMAS = (
+    # Writers wait up to 5s for the lock instead of failing with SQLITE_BUSY;
+    # set first so the WAL switch below also waits out other workers
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+)
+
+def _open_db(path):
+    """Open a long-lived autocommit connection with the tuned pragmas applied."""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                           cached_statements=DB_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
+    conn.executescript(';'.join(SQLITE_PRAGMAS))
+    return conn
+
+def _make_pool(path):
+    pool = queue.SimpleQueue()
+    for _ in range(DB_POOL_SIZE):
+        pool.put(_open_db(path))
+    return pool
+
+_AUTH_POOL = _make_pool(AUTH_DB_PATH)
+_APP_POOL = _make_pool(APP_DB_PATH)
+
+def _checkout(pool, name):
+    """Return the connection bound to this app context, borrowing one if needed."""
+    conn = g.get(name)
+    if conn is None:
+        conn = pool.get()
+        setattr(g, name, conn)
     return conn
 
+def _release(pool, name):
+    """Return this app context's connection to its pool early (no-op if none is held)."""
+    conn = g.pop(name, None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+@app.teardown_appcontext
+def release_dbs(exc):
+    """Hand request-scoped connections back to their pools."""
+    for name, pool in (('auth_db', _AUTH_POOL), ('app_db', _APP_POOL)):
+        _release(pool, name)
+
+@atexit.register
+def close_db_pools():
+    """Close idle pooled connections so the last one checkpoints and removes the WAL."""
+    for pool in (_AUTH_POOL, _APP_POOL):
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute('PRAGMA optimize')
+                conn.close()
+            except sqlite3.Error as e:
+                logging.warning(f"[DB] Error closing pooled connection: {e}")
+
+@contextmanager
+def txn(conn):
+    """Run a block as one write transaction on an autocommit connection."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        # Also covers a failed COMMIT, which leaves the transaction open;
+        # a long-lived connection must never be left inside one
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+# --- Write Coalescing ---
+class WriteCoalescer:
+    """One background writer that commits queued statements in batches.
+
+    Handlers submit a group of (sql, params) statements and return without
+    waiting on the SQLite write lock; the writer commits everything queued
+    within `interval` seconds (or `max_items` groups) in one transaction, so
+    a burst of inserts pays for one commit. Groups are applied in order, and
+    each stays atomic.
+    """
+
+    def __init__(self, path, interval=0.01, max_items=100, name='db-writer'):
+        # Its own connection, so commits never wait for a pooled one that a
+        # request is holding
+        self._conn = _open_db(path)
+        self._interval = interval
+        self._max_items = max_items
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, statements, after=None):
+        """Queue statements to commit together; `after` runs once they are committed.
+
+        Returns a Future that resolves after the commit, for callers that
+        need to know the rows are durable.
+        """
+        future = Future()
+        self._queue.put((statements, after, future))
+        return future
+
+    def close(self, timeout=5):
+        """Flush everything queued so far and stop the writer."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            try:
+                self._conn.execute('PRAGMA optimize')
+                self._conn.close()
+            except sqlite3.Error as e:
+                logging.warning(f"[DB] Error closing writer connection: {e}")
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._interval
+            while len(batch) < self._max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # None is the shutdown sentinel: write what came before it, then stop
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+            if batch:
+                # Nothing may escape here: a dead writer would drop every later write
+                try:
+                    self._flush(batch)
+                except Exception as e:
+                    logging.exception("[DB] Write batch failed")
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+    @staticmethod
+    def _apply(conn, statements):
+        for sql, params in statements:
+            conn.execute(sql, params)
+
+    def _flush(self, batch):
+        conn = self._conn
+        try:
+            with txn(conn):
+                for statements, _, _ in batch:
+                    self._apply(conn, statements)
+            results = [None] * len(batch)
+        except Exception:
+            # One bad group shouldn't sink the rest: retry them one at a time
+            # (bad params raise OverflowError/TypeError as well as sqlite3.Error)
+            results = []
+            for statements, _, _ in batch:
+                try:
+                    with txn(conn):
+                        self._apply(conn, statements)
+                    results.append(None)
+                except Exception as e:
+                    logging.error(f"[DB] Queued write failed: {e}")
+                    results.append(e)
+
+        for (_, after, future), error in zip(batch, results):
+            if error is not None:
+                future.set_exception(error)
+                continue
+            if after is not None:
+                try:
+                    after()
+                except Exception as e:
+                    logging.error(f"[DB] Post-commit hook failed: {e}")
+            future.set_result(None)
+
+# App DB inserts from request handlers go through here; at exit it flushes
+# what is queued and closes its connection.
+_db_writer = WriteCoalescer(APP_DB_PATH)
+atexit.register(_db_writer.close)
+
+# --- Schema Migrations ---
+# Each database records its schema version in PRAGMA user_version. Startup
+# only runs the steps a file has not seen yet, inside one transaction, so a
+# warm boot does no DDL (and never rebuilds tables).
+AUTH_SCHEMA_VERSION = 1
+APP_SCHEMA_VERSION = 4
+
+def _migrate(conn, target_version, steps):
+    """Apply steps[v] for every version v in (current, target] and record the result."""
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= target_version:
+        return
+    with txn(conn):
+        # Several workers can boot at once: whoever gets the write lock first
+        # migrates, and the rest see the new version here and skip
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version in range(current + 1, target_version + 1):
+            logging.info(f"[DB] Applying schema migration v{version}")
+            steps[version](conn)
+        if current < target_version:
+            conn.execute(f'PRAGMA user_version = {target_version}')
+
+def _add_missing_columns(conn, table, columns):
+    """ALTER TABLE ADD COLUMN for each (name, decl) the table lacks; returns the names added."""
+    existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    added = set()
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+            added.add(name)
+    return added
+
+# --- Auth DB ---
+def get_auth_db():
+    return _checkout(_AUTH_POOL, 'auth_db')
+
+def _auth_schema_v1(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+
 def init_auth_db():
-    with get_auth_db() as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        ''')
+    _migrate(get_auth_db(), AUTH_SCHEMA_VERSION, {1: _auth_schema_v1})
 
 # --- App DB (health data) ---
 def get_app_db():
-    conn = sqlite3.connect(APP_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_app_db():
-    with get_app_db() as conn:
-        # Updated daily_checkins table
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS daily_checkins (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                date TEXT NOT NULL,
-                answers TEXT NOT NULL,
-                notes TEXT,
-                topK INTEGER,
-                explainMethod TEXT,
-                useScipyWinsorize BOOLEAN,
-                forceLocal BOOLEAN,
-                questions TEXT,
-                question_version TEXT,
-                llm_analysis TEXT
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS feedback (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                feedback TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS uploads (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        # NEW: Table for report analysis
+    return _checkout(_APP_POOL, 'app_db')
+
+def release_app_db():
+    """Hand the app connection back before a slow LLM call; later reads borrow a fresh one."""
+    _release(_APP_POOL, 'app_db')
+
+def _app_schema_v1(conn):
+    # Updated daily_checkins table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_checkins (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            answers TEXT NOT NULL,
+            notes TEXT,
+            topK INTEGER,
+            explainMethod TEXT,
+            useScipyWinsorize BOOLEAN,
+            forceLocal BOOLEAN,
+            questions TEXT,
+            question_version TEXT,
+            llm_analysis TEXT,
+            score REAL,
+            analysis_status TEXT
+        )
+    ''')
+    # Older databases predate these columns: add them and backfill once
+    added = _add_missing_columns(conn, 'daily_checkins', (
+        ('score', 'REAL'),
+        ('analysis_status', 'TEXT'),
+    ))
+    if 'score' in added:
         conn.execute('''
-            CREATE TABLE IF NOT EXISTS report_analyses (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                upload_id TEXT NOT NULL,
-                ocr_text TEXT,
-                llm_analysis TEXT,
-                findings TEXT,
-                urgency_level INTEGER,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (upload_id) REFERENCES uploads (id)
+            UPDATE daily_checkins SET score = (
+                SELECT AVG(j.value)
+                FROM json_each(CASE WHEN json_valid(daily_checkins.answers) THEN daily_checkins.answers END) AS j
+                WHERE j.type IN ('integer', 'real') AND j.value BETWEEN 0 AND 5
             )
         ''')
-        # UPDATED: Enhanced chat_sessions table
-        conn.execute('DROP TABLE IF EXISTS chat_sessions') # Drop old one
+    if 'analysis_status' in added:
         conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                message TEXT NOT NULL,
-                response TEXT NOT NULL,
-                context TEXT,
-                confidence_score REAL,
-                created_at TEXT NOT NULL
-            )
+            UPDATE daily_checkins
+            SET analysis_status = CASE WHEN llm_analysis IS NULL THEN 'failed' ELSE 'complete' END
         ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS feedback (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            feedback TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    # NEW: Table for report analysis
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS report_analyses (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            upload_id TEXT NOT NULL,
+            ocr_text TEXT,
+            llm_analysis TEXT,
+            findings TEXT,
+            urgency_level INTEGER,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (upload_id) REFERENCES uploads (id)
+        )
+    ''')
+    # UPDATED: Enhanced chat_sessions table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            context TEXT,
+            confidence_score REAL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    # Chat tables created before the "enhanced" schema lack these columns
+    _add_missing_columns(conn, 'chat_sessions', (
+        ('context', 'TEXT'),
+        ('confidence_score', 'REAL'),
+    ))
+    # Indexes backing the per-user "latest first" reads
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_checkins_user_date ON daily_checkins(user_id, date DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_user_created ON uploads(user_id, created_at DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_user_created ON chat_sessions(user_id, created_at DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reports_user_created ON report_analyses(user_id, created_at DESC)')
+    # Refresh planner statistics so the indexes above are picked up
+    conn.execute('ANALYZE')
+
+def _app_schema_v2(conn):
+    # Rolling per-user chat summary; turns up to summarized_until are folded in
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_memory (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_until TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+def _app_schema_v3(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_feedback_user_created ON feedback(user_id, created_at DESC)')
+
+def _app_schema_v4(conn):
+    # Chat rows reference a deduplicated context snapshot instead of embedding it
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS context_snapshots (
+            hash TEXT PRIMARY KEY,
+            blob BLOB NOT NULL
+        )
+    ''')
+    _add_missing_columns(conn, 'chat_sessions', (('context_hash', 'TEXT'),))
+
+def init_app_db():
+    _migrate(get_app_db(), APP_SCHEMA_VERSION, {
+        1: _app_schema_v1, 2: _app_schema_v2, 3: _app_schema_v3, 4: _app_schema_v4,
+    })
 
 # Initialize databases
-init_auth_db()
-init_app_db()
+with app.app_context():
+    init_auth_db()
+    init_app_db()
+
+# --- Compressed Columns ---
+# Bulky JSON/text that SQL never inspects (OCR text, report analyses, check-in
+# questions) is stored as a version byte + zstd frame. Rows written before
+# this lack the prefix and are returned as-is.
+_BLOB_V1 = b'\x01'
+_zstd_local = threading.local()  # zstd contexts are not safe to share across threads
+
+def _zstd():
+    if not hasattr(_zstd_local, 'c'):
+        _zstd_local.c = zstd.ZstdCompressor(level=3)
+        _zstd_local.d = zstd.ZstdDecompressor()
+    return _zstd_local
+
+def pack_blob(data):
+    """Compress text/bytes for a BLOB column."""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return _BLOB_V1 + _zstd().c.compress(data)
+
+def unpack_blob(value):
+    """Inverse of pack_blob; legacy TEXT values pass through unchanged."""
+    if isinstance(value, bytes) and value[:1] == _BLOB_V1:
+        return _zstd().d.decompress(value[1:])
+    return value
+
+# --- SQL Statements ---
+# Request-path queries share one SQL string each so pooled connections keep
+# the compiled statement in their cache instead of re-parsing it per request.
+
+# users
+_SQL_INSERT_USER = 'INSERT INTO users (id, email, password_hash, created_at) VALUES (?, ?, ?, ?)'
+_SQL_LOGIN_USER = 'SELECT id, password_hash FROM users WHERE email = ?'
+_SQL_USER_EMAIL = 'SELECT email FROM users WHERE id = ?'
+
+# daily_checkins
+_SQL_INSERT_CHECKIN = '''INSERT INTO daily_checkins
+    (id, user_id, date, answers, notes, topK, explainMethod, useScipyWinsorize, forceLocal, questions, question_version, score, analysis_status)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')'''
+_SQL_UPDATE_CHECKIN_ANALYSIS = '''UPDATE daily_checkins SET llm_analysis = ?, analysis_status = 'complete'
+    WHERE id = ? AND user_id = ?'''
+_SQL_FAIL_CHECKIN_ANALYSIS = "UPDATE daily_checkins SET analysis_status = 'failed' WHERE id = ? AND user_id = ?"
+_SQL_CHECKIN_ANALYSIS = 'SELECT analysis_status, llm_analysis, date FROM daily_checkins WHERE id = ? AND user_id = ?'
+_SQL_EXPIRE_CHECKIN_ANALYSIS = '''UPDATE daily_checkins SET analysis_status = 'failed'
+    WHERE analysis_status = 'pending' AND id = ? AND user_id = ?'''
+_SQL_RECENT_CHECKINS = 'SELECT date, answers, notes, llm_analysis FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT ?'
+_SQL_RECENT_CHECKINS_PROMPT = 'SELECT date, answers, notes FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT ?'
+_SQL_LIST_CHECKINS = '''SELECT id, user_id, date, answers, notes, topK, explainMethod, useScipyWinsorize,
+    forceLocal, llm_analysis, questions
+    FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT ?'''
+# json_valid guards json_extract, which raises on malformed text
+_SQL_RISK_SERIES = '''SELECT date, CAST(json_extract(llm_analysis, '$.risk_score') AS REAL) * 100 AS risk_score
+    FROM daily_checkins
+    WHERE user_id = ? AND llm_analysis IS NOT NULL
+      AND json_extract(CASE WHEN json_valid(llm_analysis) THEN llm_analysis END, '$.risk_score') IS NOT NULL
+    ORDER BY date ASC LIMIT 30'''
+_SQL_WELLNESS_STATS = '''SELECT COUNT(*) AS checkins, AVG(score) AS avg_score FROM (
+    SELECT score FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT 7
+)'''
+
+# chat_sessions / user_memory
+_SQL_INSERT_CHAT = '''INSERT INTO chat_sessions
+    (id, user_id, message, response, context_hash, confidence_score, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)'''
+_SQL_INSERT_CONTEXT_SNAPSHOT = 'INSERT OR IGNORE INTO context_snapshots (hash, blob) VALUES (?, ?)'
+_SQL_UNSUMMARIZED_CHAT_TURNS = '''SELECT message, response FROM chat_sessions
+    WHERE user_id = ? AND created_at > ?
+    ORDER BY created_at DESC LIMIT ?'''
+_SQL_COUNT_CHATS_SINCE = 'SELECT COUNT(*) FROM chat_sessions WHERE user_id = ? AND created_at > ?'
+_SQL_CHATS_TO_SUMMARIZE = '''SELECT message, response, created_at FROM chat_sessions
+    WHERE user_id = ? AND created_at > ?
+    ORDER BY created_at DESC LIMIT -1 OFFSET ?'''
+_SQL_SELECT_MEMORY = 'SELECT summary, summarized_until FROM user_memory WHERE user_id = ?'
+_SQL_UPSERT_MEMORY = '''INSERT INTO user_memory (user_id, summary, summarized_until, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary,
+        summarized_until = excluded.summarized_until, updated_at = excluded.updated_at'''
+
+# uploads / report_analyses / feedback
+_SQL_INSERT_UPLOAD = 'INSERT INTO uploads (id, user_id, filename, created_at) VALUES (?, ?, ?, ?)'
+_SQL_INSERT_REPORT_ANALYSIS = '''INSERT INTO report_analyses
+    (id, user_id, upload_id, ocr_text, llm_analysis, findings, urgency_level, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+_SQL_INSERT_FEEDBACK = 'INSERT INTO feedback (id, user_id, feedback, created_at) VALUES (?, ?, ?, ?)'
+
+# dashboard
+_SQL_RECENT_ACTIVITY = '''SELECT id, 'checkin' AS kind, date AS ts, NULL AS extra FROM daily_checkins WHERE user_id = ?
+    UNION ALL
+    SELECT id, 'report', created_at, filename FROM uploads WHERE user_id = ?
+    UNION ALL
+    SELECT id, 'chat', created_at, message FROM chat_sessions WHERE user_id = ?
+    ORDER BY ts DESC LIMIT 5'''
+
+# --- ID & Time Helpers ---
+_UTC = timezone.utc
+
+def _now_iso() -> str:
+    """Current UTC time as a fixed-width ISO-8601 string (sorts lexically)."""
+    return datetime.now(_UTC).isoformat(timespec='microseconds')
+
+def _new_id() -> str:
+    """Random row id: 32 hex chars (uuid4 without the dashes)."""
+    return uuid.uuid4().hex
 
 # --- Auth Helpers ---
+# bcrypt releases the GIL inside its C core, so hashing on a shared pool lets
+# concurrent signups/logins use every core instead of queueing on one worker.
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='bcrypt')
+# Cost 11 is ~100 ms per hash on current hardware; each step up doubles it
+# (12 is the library default). BCRYPT_COST lets dev boxes go lower and
+# production go higher. Existing hashes keep their own cost and still verify.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_COST', 11))
+
 def hash_password(password: str) -> bytes:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return _HASH_POOL.submit(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).result()
 
 def verify_password(password: str, hashed: bytes) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+    return _HASH_POOL.submit(bcrypt.checkpw, password.encode('utf-8'), hashed).result()
+
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# Failed logins per (email, client IP); once exhausted, requests are refused
+# before bcrypt runs. Keying on the IP too means someone guessing elsewhere
+# can't lock the account owner out.
+LOGIN_MAX_FAILURES = 5
+_login_failures = TTLCache(maxsize=10000, ttl=300)
+_login_lock = threading.Lock()
+
+def _login_key(email: str):
+    return (email, request.remote_addr)
+
+def login_blocked(email: str) -> bool:
+    with _login_lock:
+        return _login_failures.get(_login_key(email), 0) >= LOGIN_MAX_FAILURES
+
+def record_login_failure(email: str):
+    key = _login_key(email)
+    with _login_lock:
+        _login_failures[key] = _login_failures.get(key, 0) + 1
+
+def clear_login_failures(email: str):
+    with _login_lock:
+        _login_failures.pop(_login_key(email), None)
 
 def validate_email(email: str) -> bool:
-    return re.match(r"^[^@]+@[^@]+\.[^@]+$", email.strip()) is not None
+    e = email.strip()
+    # Cheap structural checks reject most bad input before the regex runs
+    return e.count('@') == 1 and '.' in e.rpartition('@')[2] and _EMAIL_RE.match(e) is not None
 
 def require_auth(f):
     """Decorator to protect routes"""
@@ -238,88 +658,207 @@ def get_user_id():
     """Helper to get user_id from session"""
     return session.get('user_id')
 
+def _body():
+    """Decode a JSON object body with orjson, or None if it is missing or not an object.
+
+    Skips Werkzeug's mimetype check and body caching; handlers read it once.
+    """
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
 # --- LLM & DB Helper Functions ---
 
+def compute_wellness_score(answers):
+    """Mean of the numeric 0-5 answers in one check-in, or None if there are none."""
+    if not isinstance(answers, dict):
+        return None
+    values = [
+        val for val in answers.values()
+        if isinstance(val, (int, float)) and not isinstance(val, bool) and 0 <= val <= 5
+    ]
+    return sum(values) / len(values) if values else None
+
+# Short-lived per-user read caches; writers call invalidate_user_cache()
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+_cache_lock = threading.Lock()
+_ctx_cache = TTLCache(maxsize=1024, ttl=USER_CACHE_TTL)
+_checkins_cache = TTLCache(maxsize=1024, ttl=USER_CACHE_TTL)
+# Serialized dashboard responses keyed by (user_id, view name)
+DASHBOARD_CACHE_TTL = int(os.getenv('DASHBOARD_CACHE_TTL', 60))
+_dashboard_cache = TTLCache(maxsize=2048, ttl=DASHBOARD_CACHE_TTL)
+
+def invalidate_user_cache(user_id):
+    """Drop cached context/check-ins after a write for this user."""
+    with _cache_lock:
+        _ctx_cache.pop(user_id, None)
+        for key in [k for k in _checkins_cache.keys() if k[0] == user_id]:
+            _checkins_cache.pop(key, None)
+        for key in [k for k in _dashboard_cache.keys() if k[0] == user_id]:
+            _dashboard_cache.pop(key, None)
+
+def cached_per_user(view):
+    """Cache a view's 200 JSON body per user until the TTL lapses or the user writes."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (get_user_id(), view.__name__)
+        with _cache_lock:
+            body = _dashboard_cache.get(key)
+        if body is not None:
+            return Response(body, mimetype='application/json')
+        resp = view(*args, **kwargs)
+        if isinstance(resp, Response) and resp.status_code == 200:
+            with _cache_lock:
+                _dashboard_cache[key] = resp.get_data()
+        return resp
+    return wrapper
+
+def remember_chat_turn(user_id, message, response_text):
+    """Append a new turn to the cached context instead of rebuilding it from the DB."""
+    turn = f"User: {message}\nAssistant: {response_text}"
+    with _cache_lock:
+        ctx = _ctx_cache.get(user_id)
+        if ctx is not None:
+            history = ctx['conversation_history'][-(CHAT_MAX_VERBATIM_TURNS - 1):] + [turn]
+            _ctx_cache[user_id] = {**ctx, 'conversation_history': history}
+
 def get_recent_checkins(user_id, days):
     """Get last 'days' check-ins for trend analysis."""
+    key = (user_id, days)
+    with _cache_lock:
+        cached = _checkins_cache.get(key)
+    if cached is not None:
+        return cached
+
     logging.info(f"[DB] Fetching {days} recent check-ins for user {user_id}")
-    with get_app_db() as conn:
-        cur = conn.execute(
-            'SELECT date, answers, notes, llm_analysis FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT ?',
-            (user_id, days)
-        )
-        rows = cur.fetchall()
-        # Convert rows to dictionaries
-        return [dict(row) for row in rows]
+    conn = get_app_db()
+    cur = conn.execute(_SQL_RECENT_CHECKINS, (user_id, days))
+    rows = cur.fetchall()
+    # Convert rows to dictionaries
+    checkins = [dict(row) for row in rows]
+    with _cache_lock:
+        _checkins_cache[key] = checkins
+    return checkins
+
+def get_recent_checkins_as_prompt(user_id, days):
+    """Last 'days' check-ins rendered straight into prompt text (no per-row dicts)."""
+    key = (user_id, days, 'prompt')
+    with _cache_lock:
+        cached = _checkins_cache.get(key)
+    if cached is not None:
+        return cached
+
+    conn = get_app_db()
+    cur = conn.execute(_SQL_RECENT_CHECKINS_PROMPT, (user_id, days))
+    buf = io.StringIO()
+    for date, answers, notes in cur:
+        buf.write(f"[{date}] answers={answers} notes={notes}\n")
+    text = buf.getvalue() or "None"
+    with _cache_lock:
+        _checkins_cache[key] = text
+    return text
 
 def get_user_context(user_id):
     """Get user health history, concerns, etc., from DB."""
+    with _cache_lock:
+        cached = _ctx_cache.get(user_id)
+    if cached is not None:
+        return cached
+
     logging.info(f"[DB] Fetching context for user {user_id}")
     
     recent_checkins = get_recent_checkins(user_id, 7)
     
-    chat_history = []
-    with get_app_db() as conn:
-        cur = conn.execute(
-            'SELECT message, response FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC LIMIT 10',
-            (user_id,)
-        )
-        rows = cur.fetchall()
-        chat_history = [f"User: {row['message']}\nAssistant: {row['response']}" for row in rows]
-        chat_history.reverse() # Oldest to newest
+    # Turns up to summarized_until live in the rolling summary; everything
+    # after it goes in verbatim, so no turn falls between the two
+    conn = get_app_db()
+    memory = conn.execute(_SQL_SELECT_MEMORY, (user_id,)).fetchone()
+    since = memory['summarized_until'] if memory else ''
+    cur = conn.execute(_SQL_UNSUMMARIZED_CHAT_TURNS, (user_id, since, CHAT_MAX_VERBATIM_TURNS))
+    chat_history = [f"User: {message}\nAssistant: {response}" for message, response in cur]
+    chat_history.reverse() # Oldest to newest
         
     # TODO: Implement a 'user_profile' table to store these
     health_history = {"conditions": ["None specified"], "allergies": ["None specified"]}
     concerns = ["General wellness"]
 
-    return {
+    context = {
         'recent_checkins': recent_checkins,
         'health_history': health_history,
         'concerns': concerns,
-        'conversation_history': chat_history
+        'conversation_history': chat_history,
+        'conversation_summary': memory['summary'] if memory else ''
     }
+    with _cache_lock:
+        _ctx_cache[user_id] = context
+    return context
 
 def store_analysis(user_id, checkin_id, analysis_json):
     """Store the LLM's analysis in the 'daily_checkins' table."""
     logging.info(f"[DB] Storing LLM analysis for checkin {checkin_id}")
-    try:
-        with get_app_db() as conn:
-            conn.execute(
-                'UPDATE daily_checkins SET llm_analysis = ? WHERE id = ? AND user_id = ?',
-                (json.dumps(analysis_json), checkin_id, user_id)
-            )
-    except Exception as e:
-        logging.error(f"Failed to store LLM analysis: {e}")
-
-def store_report_analysis(user_id, upload_id, ocr_text, analysis_json):
-    """Store report analysis in the 'report_analyses' table."""
+    # Queued behind the check-in's own INSERT, so the row is always there
+    _db_writer.submit(
+        [(_SQL_UPDATE_CHECKIN_ANALYSIS, (orjson.dumps(analysis_json).decode(), checkin_id, user_id))],
+        after=lambda: invalidate_user_cache(user_id)
+    )
+
+def store_report_analysis(user_id, upload_id, filename, ocr_text=None, analysis_json=None, now=None):
+    """Record the upload and, if analysis succeeded, its 'report_analyses' row in one transaction."""
     logging.info(f"[DB] Storing report analysis for upload {upload_id}")
-    try:
-        analysis_id = str(uuid.uuid4())
-        with get_app_db() as conn:
-            conn.execute(
-                '''INSERT INTO report_analyses 
-                   (id, user_id, upload_id, ocr_text, llm_analysis, findings, urgency_level, created_at) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                (
-                    analysis_id,
-                    user_id,
-                    upload_id,
-                    ocr_text,
-                    json.dumps(analysis_json),
-                    json.dumps(analysis_json.get('findings', [])),
-                    analysis_json.get('urgency', 3),
-                    datetime.now(timezone.utc).isoformat()  # ✅ Fixed deprecation
-                )
+    now = now or _now_iso()
+    statements = [(_SQL_INSERT_UPLOAD, (upload_id, user_id, filename, now))]
+    if analysis_json is not None:
+        statements.append((
+            _SQL_INSERT_REPORT_ANALYSIS,
+            (
+                _new_id(),
+                user_id,
+                upload_id,
+                pack_blob(ocr_text),
+                pack_blob(orjson.dumps(analysis_json)),
+                pack_blob(orjson.dumps(analysis_json.get('findings', []))),
+                analysis_json.get('urgency', 3),
+                now
             )
-    except Exception as e:
-        logging.error(f"Failed to store report analysis: {e}")
+        ))
+    _db_writer.submit(statements)
+
+# --- OCR Worker Pool ---
+# One pool for the whole process, created on first use. Workers are started
+# with forkserver/spawn rather than fork(): forking this multi-threaded server
+# (writer thread, executors, open SQLite handles) can deadlock the child.
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', os.cpu_count() or 1))
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+def _get_ocr_pool():
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS,
+                                            mp_context=multiprocessing.get_context(method))
+        return _ocr_pool
+
+def _reset_ocr_pool(broken):
+    """Drop a pool whose worker died so the next upload starts a fresh one."""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is broken:
+            _ocr_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+@atexit.register
+def _close_ocr_pool():
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown(wait=False, cancel_futures=True)
 
 def extract_text_from_file(file_storage):
     """Real OCR: Extract text from uploaded medical documents."""
-    import pytesseract
     from PIL import Image
-    from pdf2image import convert_from_bytes
+    from pdf2image import pdfinfo_from_bytes
     import io
     
     # Optional: Try PyPDF2 for text-based PDFs first
@@ -356,14 +895,23 @@ def extract_text_from_file(file_storage):
             
             # If direct extraction failed or gave no text, use OCR
             logging.info("🔄 Processing PDF file with OCR")
-            images = convert_from_bytes(file_content, dpi=300)
-            extracted_text = ""
-            
-            for i, image in enumerate(images):
-                logging.info(f"Processing PDF page {i+1}/{len(images)}")
-                # Convert PIL image to text using OCR
-                page_text = pytesseract.image_to_string(image, lang='eng')
-                extracted_text += f"\n--- Page {i+1} ---\n{page_text}\n"
+            # OCR is CPU-bound, so fan pages out to the shared worker processes;
+            # concurrent uploads queue there instead of adding processes
+            page_count = pdfinfo_from_bytes(file_content)['Pages']
+            logging.info(f"OCR'ing {page_count} PDF pages across up to {OCR_WORKERS} processes")
+            pool = _get_ocr_pool()
+            try:
+                pages_text = list(pool.map(
+                    ocr_pdf_page,
+                    [(file_content, page) for page in range(1, page_count + 1)]
+                ))
+            except BrokenProcessPool:
+                _reset_ocr_pool(pool)
+                raise
+
+            extracted_text = "".join(
+                f"\n--- Page {i} ---\n{page_text}\n" for i, page_text in enumerate(pages_text, start=1)
+            )
             
             return extracted_text.strip() if extracted_text.strip() else None
             
@@ -373,7 +921,7 @@ def extract_text_from_file(file_storage):
             image = Image.open(io.BytesIO(file_content))
             
             # Convert image to text using OCR
-            extracted_text = pytesseract.image_to_string(image, lang='eng')
+            extracted_text = image_to_text(image)
             return extracted_text.strip() if extracted_text.strip() else None
             
         else:
@@ -386,13 +934,31 @@ def extract_text_from_file(file_storage):
         # ✅ DO NOT return fake data — return None to indicate failure
         return None
 
+# Page furniture that carries no clinical content, and runs of whitespace
+_OCR_BOILERPLATE_RE = re.compile(r'(Page \d+ of \d+|--- Page \d+ ---|Printed on.*)')
+_WHITESPACE_RE = re.compile(r'\s+')
+OCR_PROMPT_MAX_CHARS = 12000
+OCR_PROMPT_HEAD_CHARS = 8000
+OCR_PROMPT_TAIL_CHARS = 3000
+
+def prepare_ocr_for_llm(ocr_text):
+    """Strip boilerplate, collapse whitespace and cap OCR text before prompting.
+
+    LLM latency grows with prompt length, so very long scans keep only their
+    head and tail (where summaries and sign-offs usually are).
+    """
+    cleaned = _WHITESPACE_RE.sub(' ', _OCR_BOILERPLATE_RE.sub('', ocr_text)).strip()
+    if len(cleaned) > OCR_PROMPT_MAX_CHARS:
+        cleaned = cleaned[:OCR_PROMPT_HEAD_CHARS] + '\n...[truncated]...\n' + cleaned[-OCR_PROMPT_TAIL_CHARS:]
+    return cleaned
+
 def parse_questions(llm_response_text):
     """Safely parse the LLM's JSON-formatted question list."""
     logging.info("Parsing LLM question response")
     try:
         if "```json" in llm_response_text:
             llm_response_text = llm_response_text.split("```json\n")[1].split("\n```")[0]
-        return json.loads(llm_response_text)
+        return orjson.loads(llm_response_text)
     except Exception as e:
         logging.error(f"Failed to parse questions JSON: {e} - Response was: {llm_response_text}")
         return [{"id": "q_error", "question": "Error: Could not generate dynamic questions. Please use the default.", "type": "scale", "options": [], "required": False, "category": "error"}]
@@ -403,7 +969,7 @@ def parse_json_response(llm_response_text):
     try:
         if "```json" in llm_response_text:
             llm_response_text = llm_response_text.split("```json\n")[1].split("\n```")[0]
-        return json.loads(llm_response_text)
+        return orjson.loads(llm_response_text)
     except Exception as e:
         logging.error(f"Failed to parse JSON: {e} - Response was: {llm_response_text}")
         return {"error": "Failed to parse LLM analysis."}
@@ -422,10 +988,160 @@ def assess_response_confidence(response_text):
     # A real implementation might look at token probabilities
     return 0.95
 
+# The chat prompt asks for a JSON trailer after this marker so actions and
+# confidence come from one parse instead of scanning the reply text
+CHAT_META_MARKER = '---META---'
+
+def split_chat_meta(response_text):
+    """Split a chat reply into (body, suggested_actions, confidence).
+
+    Falls back to the text heuristics when the model leaves out the trailer
+    or it does not parse.
+    """
+    body, marker, meta_text = response_text.rpartition(CHAT_META_MARKER)
+    meta = None
+    if marker:
+        body = body.strip()
+        try:
+            meta = orjson.loads(meta_text.strip().strip('`'))
+        except orjson.JSONDecodeError:
+            meta = None
+    else:
+        body = response_text.strip()
+    if not isinstance(meta, dict):
+        return body, extract_suggested_actions(body), assess_response_confidence(body)
+
+    actions = [a for a in meta.get('suggested_actions') or [] if isinstance(a, str)][:5]
+    try:
+        confidence = min(1.0, max(0.0, float(meta.get('confidence'))))
+    except (TypeError, ValueError):
+        confidence = assess_response_confidence(body)
+    return body, actions, confidence
+
+def build_chat_prompt(user_context, message):
+    """Build the chatbot prompt from the user's context and latest message."""
+    return f"""
+    You are 'Health Sphere', a helpful and empathetic health assistant.
+    Respond to the user's query.
+    
+    **Guidelines:**
+    - Provide helpful, general health information.
+    - Be empathetic and supportive.
+    - **Crucially: Do not provide specific medical diagnoses or treatment plans.**
+    - Always suggest consulting a healthcare provider for medical advice, diagnosis, or persistent symptoms.
+    
+    **User Context (For Your Information Only - Do Not Repeat to User):**
+    - Health History: {user_context.get('health_history', {})}
+    - Recent Concerns: {user_context.get('concerns', [])}
+    
+    **Summary of Earlier Conversation:**
+    {user_context.get('conversation_summary') or 'None'}
+    
+    **Recent Conversation (Oldest to Newest):**
+    {user_context.get('conversation_history', [])}
+    
+    **User Query:**
+    {message}
+    
+    **Output Format:**
+    Write your reply, then a final line `{CHAT_META_MARKER}` followed by a JSON object:
+    {{"suggested_actions": [up to 3 short next steps], "confidence": a number from 0.0 to 1.0}}
+    
+    **Your Response:**
+    """
+
+def store_chat(user_id, message, response_text, user_context, confidence):
+    """Queue one chat turn for the DB writer and return its id (None if not stored)."""
+    # Empty replies and LLM/connection errors aren't worth a history row
+    if not response_text or response_text.startswith('Error:'):
+        return None
+    chat_id = _new_id()
+    # conversation_history is just the preceding chat rows, so the snapshot
+    # leaves it out; what remains rarely changes turn to turn and dedupes well
+    snapshot = orjson.dumps(
+        {k: v for k, v in user_context.items() if k != 'conversation_history'},
+        option=orjson.OPT_SORT_KEYS
+    )
+    ctx_hash = hashlib.blake2b(snapshot, digest_size=16).hexdigest()
+    _db_writer.submit([
+        (_SQL_INSERT_CONTEXT_SNAPSHOT, (ctx_hash, pack_blob(snapshot))),
+        (_SQL_INSERT_CHAT, (
+            chat_id, 
+            user_id, 
+            message, 
+            response_text, 
+            ctx_hash,
+            confidence, 
+            _now_iso()
+        )),
+    ])
+    remember_chat_turn(user_id, message, response_text)
+    schedule_chat_summary(user_id)
+    return chat_id
+
+# --- Chat memory ---
+CHAT_RECENT_TURNS = 5       # turns left unsummarized after a refresh
+CHAT_SUMMARY_TRIGGER = 10   # unsummarized turns before the summary is refreshed
+# Every unsummarized turn goes in verbatim; this only bites if refreshes keep failing
+CHAT_MAX_VERBATIM_TURNS = 2 * CHAT_SUMMARY_TRIGGER
+_summary_lock = threading.Lock()
+_summarizing = set()
+
+def schedule_chat_summary(user_id):
+    """Queue a summary refresh once enough turns have piled up since the last one."""
+    conn = get_app_db()
+    memory = conn.execute(_SQL_SELECT_MEMORY, (user_id,)).fetchone()
+    since = memory['summarized_until'] if memory else ''
+    pending = conn.execute(_SQL_COUNT_CHATS_SINCE, (user_id, since)).fetchone()[0]
+    if pending <= CHAT_SUMMARY_TRIGGER:
+        return
+    with _summary_lock:
+        if user_id in _summarizing:
+            return
+        _summarizing.add(user_id)
+    _LLM_POOL.submit(_run_chat_summary, user_id)
+
+def _run_chat_summary(user_id):
+    """Background job: fold turns older than the verbatim window into the summary."""
+    try:
+        with app.app_context():
+            conn = get_app_db()
+            memory = conn.execute(_SQL_SELECT_MEMORY, (user_id,)).fetchone()
+            summary, since = (memory['summary'], memory['summarized_until']) if memory else ('', '')
+            rows = conn.execute(_SQL_CHATS_TO_SUMMARIZE, (user_id, since, CHAT_RECENT_TURNS)).fetchall()
+            if not rows:
+                return
+            rows.reverse()
+            release_app_db()
+            turns = "\n".join(f"User: {m}\nAssistant: {r}" for m, r, _ in rows)
+            prompt = f"""
+            Update the running summary of a user's conversation with a health assistant.
+            Keep symptoms, conditions, medications, and advice already given; drop small talk.
+            Reply with the updated summary only, in under 150 words.
+            
+            Current summary: {summary or 'None'}
+            
+            New turns (oldest to newest):
+            {turns}
+            """
+            new_summary = llm_service.call_llm(prompt, max_tokens=300, temperature=0.3)
+            if not new_summary or new_summary.startswith('Error:'):
+                return
+            get_app_db().execute(
+                _SQL_UPSERT_MEMORY,
+                (user_id, new_summary, rows[-1]['created_at'], _now_iso())
+            )
+            invalidate_user_cache(user_id)
+    except Exception as e:
+        logging.error(f"Chat summary failed for user {user_id}: {e}")
+    finally:
+        with _summary_lock:
+            _summarizing.discard(user_id)
+
 # --- Auth Routes ---
 @app.route('/api/auth/signup', methods=['POST'])
 def signup():
-    data = request.get_json()
+    data = _body()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
@@ -440,14 +1156,15 @@ def signup():
         return jsonify({"error": "Password must be at least 6 characters"}), 400
 
     try:
+        # Hash before checking out a connection so none is held during bcrypt
         password_hash = hash_password(password)
-        user_id = str(uuid.uuid4())
+        user_id = _new_id()
 
-        with get_auth_db() as conn:
-            conn.execute(
-                'INSERT INTO users (id, email, password_hash, created_at) VALUES (?, ?, ?, ?)',
-                (user_id, email, password_hash, datetime.now(timezone.utc).isoformat())  # ✅ Fixed
-            )
+        conn = get_auth_db()
+        conn.execute(
+            _SQL_INSERT_USER,
+            (user_id, email, password_hash, _now_iso())
+        )
         return jsonify({"ok": True, "user": {"id": user_id, "email": email}})
     except sqlite3.IntegrityError:
         return jsonify({"error": "Email already registered"}), 409
@@ -457,7 +1174,7 @@ def signup():
 
 @app.route('/api/auth/login', methods=['POST'])
 def login():
-    data = request.get_json()
+    data = _body()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
@@ -467,15 +1184,22 @@ def login():
     if not email or not password:
         return jsonify({"error": "Email and password required"}), 400
 
-    with get_auth_db() as conn:
-        cur = conn.execute('SELECT id, email, password_hash FROM users WHERE email = ?', (email,))
-        user = cur.fetchone()
+    if login_blocked(email):
+        return jsonify({"error": "Too many failed attempts, try again later"}), 429
 
-    if user and verify_password(password, user['password_hash']):
+    conn = get_auth_db()
+    # email is the (normalized) lookup key, so only id + hash are needed back
+    user = conn.execute(_SQL_LOGIN_USER, (email,)).fetchone()
+    # Give the connection back before the ~100ms bcrypt check
+    _release(_AUTH_POOL, 'auth_db')
+
+    if user and verify_password(password, user[1]):
+        clear_login_failures(email)
         session.permanent = True  # Use configured lifetime
-        session['user_id'] = user['id']
-        return jsonify({"ok": True, "user": {"id": user['id'], "email": user['email']}})
+        session['user_id'] = user[0]
+        return jsonify({"ok": True, "user": {"id": user[0], "email": email}})
     else:
+        record_login_failure(email)
         return jsonify({"error": "Invalid email or password"}), 401
 
 @app.route('/api/auth/logout', methods=['POST'])
@@ -489,32 +1213,26 @@ def me():
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
         
-    with get_auth_db() as conn:
-        cur = conn.execute('SELECT id, email FROM users WHERE id = ?', (user_id,))
-        user = cur.fetchone()
+    conn = get_auth_db()
+    # The session already carries the id; only the email has to be read
+    user = conn.execute(_SQL_USER_EMAIL, (user_id,)).fetchone()
         
     if user:
-        return jsonify({"user": {"id": user['id'], "email": user['email']}})
+        return jsonify({"user": {"id": user_id, "email": user[0]}})
     else:
         session.pop('user_id', None)
         return jsonify({"error": "User not found"}), 401
 
 # --- Health & AI Endpoints (Protected) ---
-def format_relative_time(iso_str):
+def format_relative_time(iso_str, now=None):
+    """Humanize a stored timestamp relative to `now` (an aware UTC datetime)."""
     try:
-        # Handle both formats: with and without timezone
-        if iso_str.endswith('Z'):
-            dt = datetime.fromisoformat(iso_str.replace("Z", "+00:00"))
-        else:
-            dt = datetime.fromisoformat(iso_str)
-        # Make dt offset-naive for comparison
-        dt = dt.replace(tzinfo=None)
-        
-        # Use timezone-aware UTC now
-        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
-        diff = now_utc - dt
-        seconds = diff.total_seconds()
-        
+        # fromisoformat handles 'Z' and offsets; legacy rows are naive UTC
+        dt = datetime.fromisoformat(iso_str)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=_UTC)
+        seconds = ((now or datetime.now(_UTC)) - dt).total_seconds()
+
         if seconds < 0:
             return "Just now" # Clock skew
         elif seconds < 60:
@@ -535,81 +1253,49 @@ def format_relative_time(iso_str):
 @require_auth
 def get_recent_activity():
     user_id = get_user_id()
-    activities = []
-
-    with get_app_db() as conn:
-        # Check-ins
-        cur = conn.execute(
-            'SELECT id, date FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT 3',
-            (user_id,)
-        )
-        for row in cur.fetchall():
-            activities.append({
-                "id": f"chk-{row['id']}",
-                "type": "checkin",
-                "title": "Daily check-in completed",
-                "timestamp": format_relative_time(row['date'])
-            })
+    conn = get_app_db()
+    # One statement across all three sources; SQLite does the merge + top-5
+    cur = conn.execute(_SQL_RECENT_ACTIVITY, (user_id, user_id, user_id))
 
-        # Uploads
-        cur = conn.execute(
-            'SELECT id, filename, created_at FROM uploads WHERE user_id = ? ORDER BY created_at DESC LIMIT 3',
-            (user_id,)
-        )
-        for row in cur.fetchall():
-            activities.append({
-                "id": f"rpt-{row['id']}",
-                "type": "report",
-                "title": f"Report analyzed: {row['filename']}",
-                "timestamp": format_relative_time(row['created_at'])
-            })
-
-        # Chat sessions
-        cur = conn.execute(
-            'SELECT id, created_at, message FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC LIMIT 3',
-            (user_id,)
-        )
-        for row in cur.fetchall():
-            activities.append({
-                "id": f"chat-{row['id']}",
-                "type": "chat",
-                "title": f"AI chat: '{row['message'][:30]}...'",
-                "timestamp": format_relative_time(row['created_at'])
-            })
+    activities = []
+    now = datetime.now(_UTC)
+    for row in cur:
+        kind = row['kind']
+        if kind == 'checkin':
+            activity_id = f"chk-{row['id']}"
+            title = "Daily check-in completed"
+        elif kind == 'report':
+            activity_id = f"rpt-{row['id']}"
+            title = f"Report analyzed: {row['extra']}"
+        else:
+            activity_id = f"chat-{row['id']}"
+            title = f"AI chat: '{row['extra'][:30]}...'"
+        activities.append({
+            "id": activity_id,
+            "type": kind,
+            "title": title,
+            "timestamp": format_relative_time(row['ts'], now)
+        })
 
-    # Sort by recency (simplified: just take latest 5)
-    return jsonify(activities[:5])
+    return jsonify(activities)
 
 @app.route('/api/dashboard/health-insights')
 @require_auth
+@cached_per_user
 def get_health_insights():
     user_id = get_user_id()
-    with get_app_db() as conn:
-        cur = conn.execute(
-            'SELECT answers FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT 7',
-            (user_id,)
-        )
-        rows = cur.fetchall()
+    conn = get_app_db()
+    # Scores are precomputed per check-in at insert time, so this is one
+    # indexed read with no JSON parsing
+    row = conn.execute(_SQL_WELLNESS_STATS, (user_id,)).fetchone()
 
-    if not rows:
+    if not row['checkins']:
         wellness_score = 0
         trend_desc = "No recent check-ins"
         rec_desc = "Complete your first daily check-in to get insights."
         label = "No data"
     else:
-        total_score = 0
-        count = 0
-        for row in rows:
-            try:
-                answers = json.loads(row['answers'])
-                for val in answers.values():
-                    if isinstance(val, (int, float)) and 0 <= val <= 5:
-                        total_score += val
-                        count += 1
-            except (json.JSONDecodeError, TypeError):
-                continue
-                
-        avg = total_score / count if count else 3
+        avg = row['avg_score'] if row['avg_score'] is not None else 3
         wellness_score = min(100, max(0, int((avg / 5) * 100)))
         label = "Good overall health" if wellness_score >= 80 else "Needs attention"
 
@@ -641,6 +1327,14 @@ def get_health_insights():
 
 # --- NEW LLM-Powered Endpoints ---
 
+# LLM analysis runs here so POST handlers return as soon as data is persisted
+_LLM_POOL = ThreadPoolExecutor(max_workers=int(os.getenv('LLM_WORKERS', 4)), thread_name_prefix='llm')
+
+CHECKIN_MAX_TOP_K = 50
+# Analyses live only in this process's queue; a row still pending after this
+# long was lost (restart/crash) and is reported as failed instead
+CHECKIN_ANALYSIS_TIMEOUT = int(os.getenv('CHECKIN_ANALYSIS_TIMEOUT', 600))
+
 @app.route('/api/generate-questions', methods=['GET'])
 @require_auth
 def generate_checkin_questions():
@@ -649,6 +1343,7 @@ def generate_checkin_questions():
     """
     user_id = get_user_id()
     context = get_user_context(user_id)
+    release_app_db()
     
     prompt = f"""
     Generate 8-10 personalized health check-in questions for user {user_id}.
@@ -683,70 +1378,129 @@ def generate_checkin_questions():
 @require_auth
 def analyze_checkin():
     """
-    Integration Point 2: Save check-in and then analyze it with LLM.
+    Integration Point 2: Save check-in and queue its LLM analysis.
     """
     user_id = get_user_id()
-    payload = request.get_json()
+    payload = _body()
     if not payload:
         return jsonify({"error": "Invalid JSON"}), 400
         
     checkin_data = payload.get('payload', {})
-    checkin_id = str(uuid.uuid4())
-    checkin_time = datetime.now(timezone.utc).isoformat()  # ✅ Fixed
-    answers = json.dumps(checkin_data.get('answers', {}))
+    if not isinstance(checkin_data, dict):
+        return jsonify({"error": "payload must be an object"}), 400
+    # Options are stored as typed columns, so reject values SQLite can't bind
+    top_k = checkin_data.get('topK', 3)
+    if type(top_k) is not int or not 1 <= top_k <= CHECKIN_MAX_TOP_K:
+        return jsonify({"error": f"topK must be an integer between 1 and {CHECKIN_MAX_TOP_K}"}), 400
+    use_winsorize = checkin_data.get('useScipyWinsorize', True)
+    force_local = checkin_data.get('forceLocal', False)
+    if not isinstance(use_winsorize, bool) or not isinstance(force_local, bool):
+        return jsonify({"error": "useScipyWinsorize and forceLocal must be booleans"}), 400
+    explain_method = checkin_data.get('explainMethod', 'auto')
+    question_version = checkin_data.get('question_version', '1.0')
     notes = checkin_data.get('notes')
+    if not isinstance(explain_method, str) or not isinstance(question_version, str) \
+            or not isinstance(notes, (str, type(None))):
+        return jsonify({"error": "explainMethod, question_version and notes must be strings"}), 400
+
+    checkin_id = _new_id()
+    checkin_time = _now_iso()
+    answers_obj = checkin_data.get('answers', {})
+    answers = orjson.dumps(answers_obj).decode()
     
-    # Step 1: Save the check-in data to the database
-    with get_app_db() as conn:
-        conn.execute(
-            '''INSERT INTO daily_checkins 
-               (id, user_id, date, answers, notes, topK, explainMethod, useScipyWinsorize, forceLocal, questions, question_version)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (
-                checkin_id,
-                user_id,
-                checkin_time,
-                answers,
-                notes,
-                checkin_data.get('topK', 3),
-                checkin_data.get('explainMethod', 'auto'),
-                checkin_data.get('useScipyWinsorize', True),
-                checkin_data.get('forceLocal', False),
-                json.dumps(checkin_data.get('questions', [])),
-                checkin_data.get('question_version', '1.0')
-            )
-        )
-    
-    # Step 2: Now, generate the LLM analysis for the data just saved
-    recent_checkins = get_recent_checkins(user_id, 7)
-    
-    prompt = f"""
-    Analyze this daily health check-in data in a professional, clinical tone:
-    
-    User: {user_id}
-    Date: {checkin_time}
-    Responses: {answers}
-    Notes: {notes}
+    # Context for the analysis: the check-ins before this one
+    recent_checkins = get_recent_checkins_as_prompt(user_id, 7)
     
-    Previous check-ins for context: {recent_checkins}
-    
-    Provide a structured JSON output with the following keys:
-    1. "risk_score": A float between 0.0 (low risk) and 1.0 (high risk).
-    2. "concerns": A list of strings identifying key concerns or red flags (e.g., "Consistently low energy").
-    3. "trends": A brief string analyzing trends (e.g., "Energy levels are trending downwards.").
-    4. "recommendations": A list of 2-3 actionable, personalized recommendations (e.g., "Consider discussing your persistent low energy with a healthcare provider.").
-    5. "summary": A one-paragraph summary of the check-in.
-    
-    Format as a single, valid JSON object.
-    """
+    # Step 1: Store the check-in row. It still goes through the batching writer,
+    # but we wait for the commit: clients poll and list it straight after the 202
+    saved = _db_writer.submit([(
+        _SQL_INSERT_CHECKIN,
+        (
+            checkin_id,
+            user_id,
+            checkin_time,
+            answers,
+            notes,
+            top_k,
+            explain_method,
+            use_winsorize,
+            force_local,
+            pack_blob(orjson.dumps(checkin_data.get('questions', []))),
+            question_version,
+            compute_wellness_score(answers_obj)
+        )
+    )], after=lambda: invalidate_user_cache(user_id))
+    try:
+        saved.result()
+    except Exception as e:
+        app.logger.error(f"Check-in save failed: {e}")
+        return jsonify({"error": "Failed to save check-in"}), 500
     
-    analysis_text = llm_service.call_llm(prompt, max_tokens=1000)
-    analysis_json = parse_json_response(analysis_text)
+    # Step 2: Analyze off the request thread; clients poll for the result
+    _LLM_POOL.submit(_run_checkin_analysis, user_id, checkin_id, checkin_time, answers, notes, recent_checkins)
     
-    if "error" not in analysis_json:
-        store_analysis(user_id, checkin_id, analysis_json)
+    return jsonify({"checkin_id": checkin_id, "status": "pending"}), 202
+
+
+def _run_checkin_analysis(user_id, checkin_id, checkin_time, answers, notes, recent_checkins):
+    """Background job: run the LLM analysis for a stored check-in and save it."""
+    with app.app_context():
+        prompt = f"""
+        Analyze this daily health check-in data in a professional, clinical tone:
+        
+        User: {user_id}
+        Date: {checkin_time}
+        Responses: {answers}
+        Notes: {notes}
+        
+        Previous check-ins for context:
+{recent_checkins}
+        
+        Provide a structured JSON output with the following keys:
+        1. "risk_score": A float between 0.0 (low risk) and 1.0 (high risk).
+        2. "concerns": A list of strings identifying key concerns or red flags (e.g., "Consistently low energy").
+        3. "trends": A brief string analyzing trends (e.g., "Energy levels are trending downwards.").
+        4. "recommendations": A list of 2-3 actionable, personalized recommendations (e.g., "Consider discussing your persistent low energy with a healthcare provider.").
+        5. "summary": A one-paragraph summary of the check-in.
+        
+        Format as a single, valid JSON object.
+        """
+        
+        try:
+            analysis_text = llm_service.call_llm(prompt, max_tokens=1000)
+            analysis_json = parse_json_response(analysis_text)
+        except Exception as e:
+            logging.error(f"Check-in analysis failed for {checkin_id}: {e}")
+            analysis_json = {"error": str(e)}
+        
+        if "error" not in analysis_json:
+            store_analysis(user_id, checkin_id, analysis_json)
+        else:
+            _db_writer.submit([(_SQL_FAIL_CHECKIN_ANALYSIS, (checkin_id, user_id))])
+
+
+@app.route('/functions/checkin/<checkin_id>/analysis')
+@require_auth
+def get_checkin_analysis(checkin_id):
+    """Poll the status/result of a queued check-in analysis."""
+    user_id = get_user_id()
+    conn = get_app_db()
+    row = conn.execute(_SQL_CHECKIN_ANALYSIS, (checkin_id, user_id)).fetchone()
+    if row is None:
+        return jsonify({"error": "Check-in not found"}), 404
+
+    status = row['analysis_status']
+    if status == 'pending':
+        cutoff = (datetime.now(_UTC) - timedelta(seconds=CHECKIN_ANALYSIS_TIMEOUT)).isoformat(timespec='microseconds')
+        if row['date'] < cutoff:
+            status = 'failed'
+            _db_writer.submit([(_SQL_EXPIRE_CHECKIN_ANALYSIS, (checkin_id, user_id))])
     
-    return jsonify(analysis_json)
+    return jsonify({
+        "checkin_id": checkin_id,
+        "status": status,
+        "analysis": orjson.loads(row['llm_analysis']) if row['llm_analysis'] else None
+    })
 
 
 @app.route('/functions/processReport', methods=['POST'])
@@ -762,13 +1516,9 @@ def process_report():
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
-    # Step 1: Save upload record
-    upload_id = str(uuid.uuid4())
-    with get_app_db() as conn:
-        conn.execute(
-            'INSERT INTO uploads (id, user_id, filename, created_at) VALUES (?, ?, ?, ?)',
-            (upload_id, user_id, file.filename, datetime.now(timezone.utc).isoformat())  # ✅ Fixed
-        )
+    # Step 1: Allocate the upload id; the row is written with the analysis
+    # so no transaction stays open across OCR and the LLM call
+    upload_id = _new_id()
     
     # Step 2: OCR extraction (real OCR)
     ocr_text = extract_text_from_file(file)
@@ -777,19 +1527,21 @@ def process_report():
     if ocr_text is None or ocr_text.strip() == "":
         error_msg = "OCR failed: Could not extract text from the document. Ensure the file is a valid PDF or image and that the server has Poppler installed."
         logging.error(f"[OCR] {error_msg} for upload {upload_id}")
+        store_report_analysis(user_id, upload_id, file.filename)
         return jsonify({
             "error": error_msg,
             "code": "ocr_failed",
             "upload_id": upload_id
         }), 422  # Unprocessable Entity
 
-    # Step 3: LLM analysis
+    # Step 3: LLM analysis (on a cleaned, length-capped copy of the OCR text)
+    prompt_text = prepare_ocr_for_llm(ocr_text)
     prompt = f"""
     Analyze this medical report text for user {user_id}:
     
     OCR Text: 
     ---
-    {ocr_text}
+    {prompt_text}
     ---
     
     Extract and analyze the following information. Format the output as a single, valid JSON object.
@@ -807,8 +1559,13 @@ def process_report():
     analysis_text = llm_service.call_llm(prompt, max_tokens=2000)
     analysis_json = parse_json_response(analysis_text)
     
-    if "error" not in analysis_json:
-        store_report_analysis(user_id, upload_id, ocr_text, analysis_json)
+    # One timestamp for the stored rows and the response
+    now = _now_iso()
+    store_report_analysis(
+        user_id, upload_id, file.filename, ocr_text,
+        analysis_json if "error" not in analysis_json else None,
+        now=now
+    )
     
     # Return structured response with OCR text and analysis
     return jsonify({
@@ -817,7 +1574,7 @@ def process_report():
             "meta": {
                 "filename": file.filename,
                 "upload_id": upload_id,
-                "processed_at": datetime.now(timezone.utc).isoformat()  # ✅ Fixed
+                "processed_at": now
             },
             "labs": analysis_json.get("lab_values", []),
             "diagnoses": analysis_json.get("diagnoses", []),
@@ -834,7 +1591,7 @@ def chat_with_llm():
     Integration Point 4: Context-aware chatbot.
     """
     user_id = get_user_id()
-    data = request.get_json()
+    data = _body()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
@@ -842,56 +1599,19 @@ def chat_with_llm():
     if not message:
         return jsonify({"error": "message is required"}), 400
 
-    # Step 1: Get user's full context
+    # Step 1: Get user's full context (then free the connection for the LLM wait)
     user_context = get_user_context(user_id)
+    release_app_db()
     
     # Step 2: Build the prompt
-    prompt = f"""
-    You are 'Health Sphere', a helpful and empathetic health assistant.
-    Respond to the user's query.
-    
-    **Guidelines:**
-    - Provide helpful, general health information.
-    - Be empathetic and supportive.
-    - **Crucially: Do not provide specific medical diagnoses or treatment plans.**
-    - Always suggest consulting a healthcare provider for medical advice, diagnosis, or persistent symptoms.
-    
-    **User Context (For Your Information Only - Do Not Repeat to User):**
-    - Health History: {user_context.get('health_history', {})}
-    - Recent Concerns: {user_context.get('concerns', [])}
-    
-    **Conversation History (Oldest to Newest):**
-    {user_context.get('conversation_history', [])}
-    
-    **User Query:**
-    {message}
-    
-    **Your Response:**
-    """
+    prompt = build_chat_prompt(user_context, message)
     
     # Step 3: Call LLM
     response_text = llm_service.call_llm(prompt, max_tokens=1000)
     
     # Step 4: Post-process and store
-    suggested_actions = extract_suggested_actions(response_text)
-    confidence = assess_response_confidence(response_text)
-    chat_id = str(uuid.uuid4())
-    
-    with get_app_db() as conn:
-        conn.execute(
-            '''INSERT INTO chat_sessions 
-               (id, user_id, message, response, context, confidence_score, created_at) 
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (
-                chat_id, 
-                user_id, 
-                message, 
-                response_text, 
-                json.dumps(user_context),
-                confidence, 
-                datetime.now(timezone.utc).isoformat()  # ✅ Fixed
-            )
-        )
+    response_text, suggested_actions, confidence = split_chat_meta(response_text)
+    chat_id = store_chat(user_id, message, response_text, user_context, confidence)
     
     return jsonify({
         "response": response_text,
@@ -901,14 +1621,88 @@ def chat_with_llm():
     })
 
 
+@app.route('/functions/chat/stream', methods=['POST'])
+@require_auth
+def chat_with_llm_stream():
+    """
+    Streaming variant of /functions/chat: relays LLM tokens as Server-Sent Events.
+    """
+    user_id = get_user_id()
+    data = _body()
+    if not data:
+        return jsonify({"error": "Invalid JSON"}), 400
+        
+    message = data.get('message', '')
+    if not message:
+        return jsonify({"error": "message is required"}), 400
+
+    user_context = get_user_context(user_id)
+    release_app_db()
+    prompt = build_chat_prompt(user_context, message)
+
+    def generate():
+        for event in chat_events(user_id, message, prompt, user_context):
+            yield f"data: {orjson.dumps(event).decode()}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+
+def chat_events(user_id, message, prompt, user_context):
+    """Yield {'delta': ...} events for one chat reply, then a final 'done' event once it is stored.
+
+    If the LLM stream fails, the final event carries 'error' and nothing is stored.
+    """
+    parts = []
+    # Relay text up to the META marker; hold back a marker-length tail in
+    # case the marker arrives split across deltas
+    pending, in_meta = '', False
+    hold = len(CHAT_META_MARKER) - 1
+    try:
+        for delta in llm_service.call_llm_stream(prompt, max_tokens=1000):
+            parts.append(delta)
+            if in_meta:
+                continue
+            pending += delta
+            idx = pending.find(CHAT_META_MARKER)
+            if idx != -1:
+                out, in_meta = pending[:idx], True
+            else:
+                cut = max(0, len(pending) - hold)
+                out, pending = pending[:cut], pending[cut:]
+            if out:
+                yield {'delta': out}
+    except LLMStreamError as e:
+        # A partial reply is not an answer: don't store or remember it
+        logging.error(f"Chat stream failed for user {user_id}: {e}")
+        yield {"done": True, "error": "The AI service is unavailable, please try again."}
+        return
+    if pending and not in_meta:
+        yield {'delta': pending}
+
+    # Store and post-process once the full reply is in
+    raw_text = "".join(parts).strip()
+    response_text, suggested_actions, confidence = split_chat_meta(raw_text)
+    chat_id = store_chat(user_id, message, response_text, user_context, confidence)
+    yield {
+        "done": True,
+        "suggested_actions": suggested_actions,
+        "confidence": confidence,
+        "chat_id": chat_id
+    }
+
+
 # --- Other/Mock Endpoints ---
 
+# Probe bodies are constant, so encode them once
+_HEALTH_BYTES = orjson.dumps({
+    "ok": True,
+    "python": {"available": True, "version": "3.11.9"}
+})
+_HELLO_BYTES = orjson.dumps({"message": "Flask backend ready with SQLite auth and LLM integration!"})
+
 @app.route('/api/ai/health')
 def ai_health():
-    return jsonify({
-        "ok": True,
-        "python": {"available": True, "version": "3.11.9"}
-    })
+    return Response(_HEALTH_BYTES, mimetype='application/json')
 
 @app.route('/api/analyze', methods=['POST'])
 @require_auth
@@ -922,7 +1716,7 @@ def analyze():
 @app.route('/api/pdf-extract', methods=['POST'])
 @require_auth
 def pdf_extract():
-    data = request.get_json()
+    data = _body()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
@@ -939,56 +1733,40 @@ def pdf_extract():
 def get_checkins():
     user_id = get_user_id()
     limit = request.args.get('limit', 30, type=int)
-    with get_app_db() as conn:
-        cur = conn.execute(
-            'SELECT * FROM daily_checkins WHERE user_id = ? ORDER BY date DESC LIMIT ?',
-            (user_id, limit)
-        )
-        rows = cur.fetchall()
+    conn = get_app_db()
+    cur = conn.execute(_SQL_LIST_CHECKINS, (user_id, limit))
+    loads = orjson.loads
     checkins = []
-    for row in rows:
+    # Positional unpacking matches the column order in _SQL_LIST_CHECKINS
+    for (checkin_id, uid, date, answers, notes, top_k, explain_method,
+         use_winsorize, force_local, llm_analysis, questions) in cur:
         try:
             checkins.append({
-                "id": row["id"],
-                "user_id": row["user_id"],
-                "date": row["date"],
-                "answers": json.loads(row["answers"]),
-                "notes": row["notes"],
-                "topK": row["topK"],
-                "explainMethod": row["explainMethod"],
-                "useScipyWinsorize": bool(row["useScipyWinsorize"]),
-                "forceLocal": bool(row["forceLocal"]),
-                "llm_analysis": json.loads(row["llm_analysis"]) if row["llm_analysis"] else None,
-                "questions": json.loads(row["questions"]) if row["questions"] else None,
+                "id": checkin_id,
+                "user_id": uid,
+                "date": date,
+                "answers": loads(answers),
+                "notes": notes,
+                "topK": top_k,
+                "explainMethod": explain_method,
+                "useScipyWinsorize": bool(use_winsorize),
+                "forceLocal": bool(force_local),
+                "llm_analysis": loads(llm_analysis) if llm_analysis else None,
+                "questions": loads(unpack_blob(questions)) if questions else None,
             })
-        except (json.JSONDecodeError, TypeError):
+        except (orjson.JSONDecodeError, TypeError):
             continue
             
     return jsonify(checkins)
 
 @app.route('/functions/riskSeries')
 @require_auth
+@cached_per_user
 def get_risk_series():
     user_id = get_user_id()
-    with get_app_db() as conn:
-        cur = conn.execute(
-            'SELECT date, llm_analysis FROM daily_checkins WHERE user_id = ? AND llm_analysis IS NOT NULL ORDER BY date ASC LIMIT 30',
-            (user_id,)
-        )
-        rows = cur.fetchall()
-    
-    risk_data = []
-    for row in rows:
-        try:
-            analysis = json.loads(row['llm_analysis'])
-            risk_score = analysis.get('risk_score')
-            if risk_score is not None:
-                risk_data.append({
-                    "date": row['date'],
-                    "risk_score": risk_score * 100
-                })
-        except (json.JSONDecodeError, TypeError):
-            continue
+    conn = get_app_db()
+    cur = conn.execute(_SQL_RISK_SERIES, (user_id,))
+    risk_data = [{"date": date, "risk_score": risk_score} for date, risk_score in cur]
     
     return jsonify(risk_data)
 
@@ -996,7 +1774,7 @@ def get_risk_series():
 @require_auth
 def submit_feedback():
     user_id = get_user_id()
-    data = request.get_json()
+    data = _body()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
@@ -1004,12 +1782,8 @@ def submit_feedback():
     if not feedback.strip():
         return jsonify({"error": "Feedback is required"}), 400
     
-    feedback_id = str(uuid.uuid4())
-    with get_app_db() as conn:
-        conn.execute(
-            'INSERT INTO feedback (id, user_id, feedback, created_at) VALUES (?, ?, ?, ?)',
-            (feedback_id, user_id, feedback, datetime.now(timezone.utc).isoformat())  # ✅ Fixed
-        )
+    feedback_id = _new_id()
+    _db_writer.submit([(_SQL_INSERT_FEEDBACK, (feedback_id, user_id, feedback, _now_iso()))])
     
     return jsonify({"ok": True, "feedbackId": feedback_id})
 
@@ -1067,8 +1841,9 @@ def generate_report_summary():
 
 @app.route('/')
 def hello():
-    return jsonify({"message": "Flask backend ready with SQLite auth and LLM integration!"})
+    return Response(_HELLO_BYTES, mimetype='application/json')
 
+# Development server only; production runs under gunicorn (gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8080))
     
@@ -1077,4 +1852,4 @@ if __name__ == '__main__':
     print(f"🔐 Auth: Session-based with SQLite")
     print(f"🌐 CORS: Enabled for localhost:5173")
     
-    app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(debug=os.getenv('FLASK_ENV', 'development') == 'development', host='0.0.0.0', port=port)
\ No newline at end of file
@@ -1,27 +1,45 @@
 # backend/services/llm_service.py
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
 import os
 import logging
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv(dotenv_path='../.env') # Assumes .env is in the root, one level up
 
+class LLMStreamError(Exception):
+    """A streamed completion failed; raised instead of yielding error text as content."""
+
+
 class LMStudioService:
     def __init__(self):
         # Get config from environment variables
         self.base_url = os.getenv("LM_STUDIO_URL", "http://192.168.96.1:1234")
         self.model_name = os.getenv("LM_STUDIO_MODEL", "yourmodel") # Change default if needed
         self.api_endpoint = f"{self.base_url}/v1/chat/completions"
+        # Keep-alive session so back-to-back LLM calls reuse the TCP connection.
+        # The pool is sized for concurrent Flask threads so requests overlap
+        # their LLM calls instead of queueing for a free connection.
+        pool_size = int(os.getenv("LM_STUDIO_POOL_SIZE", 20))
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(
+            pool_connections=1,  # a single host: LM Studio
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        ))
+        # Cap in-flight generations so a burst of chat/report requests queues
+        # here instead of overloading LM Studio (which serialises them anyway)
+        self._slots = threading.BoundedSemaphore(int(os.getenv("LM_STUDIO_MAX_CONCURRENCY", 8)))
         logging.info(f"Initializing LMStudioService for model: {self.model_name} at {self.base_url}")
 
-    def call_llm(self, prompt, max_tokens=1000, temperature=0.7):
-        """
-        Calls the LM Studio OpenAI-compatible API.
-        """
-        payload = {
+    def _build_payload(self, prompt, max_tokens, temperature, stream):
+        return {
             "model": self.model_name,
             "messages": [
                 {"role": "system", "content": "You are a helpful assistant."},
@@ -29,20 +47,28 @@ class LMStudioService:
             ],
             "max_tokens": max_tokens,
             "temperature": temperature,
-            "stream": False # Ensure we get a complete response, not a stream
+            "stream": stream
         }
+
+    def call_llm(self, prompt, max_tokens=1000, temperature=0.7):
+        """
+        Calls the LM Studio OpenAI-compatible API.
+        """
+        # JSON-mode callers parse the whole reply at once, so no need to stream
+        payload = self._build_payload(prompt, max_tokens, temperature, stream=False)
         
         headers = {
             "Content-Type": "application/json"
         }
         
         try:
-            response = requests.post(
-                self.api_endpoint,
-                json=payload,
-                headers=headers,
-                timeout=999999  # 120-second timeout for potentially long responses
-            )
+            with self._slots:
+                response = self.session.post(
+                    self.api_endpoint,
+                    json=payload,
+                    headers=headers,
+                    timeout=(5, 120)  # (connect, read) - generation can take a while
+                )
             
             # Check for HTTP errors
             response.raise_for_status()
@@ -63,4 +89,47 @@ class LMStudioService:
             return f"Error: Could not connect to LLM service. {e}"
         except json.JSONDecodeError:
             logging.error(f"Failed to decode JSON response: {response.text}")
-            return "Error: Failed to decode LLM response."
\ No newline at end of file
+            return "Error: Failed to decode LLM response."
+
+    def call_llm_stream(self, prompt, max_tokens=1000, temperature=0.7):
+        """
+        Streams a completion from LM Studio, yielding content deltas as they arrive.
+        Raises LLMStreamError if the request fails, even after some deltas.
+        """
+        payload = self._build_payload(prompt, max_tokens, temperature, stream=True)
+        headers = {
+            "Content-Type": "application/json"
+        }
+
+        try:
+            with self._slots, self.session.post(
+                self.api_endpoint,
+                json=payload,
+                headers=headers,
+                timeout=(5, 120),  # read timeout applies between chunks
+                stream=True
+            ) as response:
+                response.raise_for_status()
+
+                # OpenAI-style SSE: "data: {...}" lines, terminated by "data: [DONE]"
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = orjson.loads(data)
+                    except orjson.JSONDecodeError:
+                        logging.warning(f"Skipping undecodable stream chunk: {data}")
+                        continue
+                    choices = chunk.get("choices") or []
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error streaming from LM Studio API: {e}")
+            # Deltas may already be out, so this can't be reported as text
+            raise LLMStreamError(f"Could not connect to LLM service. {e}") from e
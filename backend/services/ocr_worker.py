@@ -0,0 +1,32 @@
+# backend/services/ocr_worker.py
+#
+# Kept free of app imports: OCR worker processes start fresh (spawn/forkserver)
+# and import only this module, not the Flask app with its pools and threads.
+
+import threading
+
+# One initialized tesserocr API per thread (and so per OCR worker process)
+_tess_local = threading.local()
+
+def image_to_text(image):
+    """OCR a PIL image, preferring the in-process tesserocr binding over pytesseract."""
+    try:
+        from tesserocr import PyTessBaseAPI
+    except ImportError:
+        # pytesseract forks a tesseract subprocess per call
+        import pytesseract
+        return pytesseract.image_to_string(image, lang='eng')
+
+    api = getattr(_tess_local, 'api', None)
+    if api is None:
+        api = _tess_local.api = PyTessBaseAPI(lang='eng')
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+def ocr_pdf_page(job):
+    """OCR a single PDF page. Runs in a worker process, so only that page is rasterized."""
+    from pdf2image import convert_from_bytes
+
+    file_content, page_number = job
+    image = convert_from_bytes(file_content, dpi=300, first_page=page_number, last_page=page_number)[0]
+    return image_to_text(image)
@@ -6,7 +6,7 @@ import Spinner from '../components/ui/Spinner';
 import { useToast } from '../components/ui/ToastProvider';
 import { useAuth } from '../context/AuthContext';
 import RiskChart from '../components/RiskChart';
-import { analyzeCheckinApi, aiHealth, fetchRiskSeries, fetchCheckins, generateQuestionsApi } from '../services/api';
+import { analyzeCheckinApi, waitForCheckinAnalysis, aiHealth, fetchRiskSeries, fetchCheckins, generateQuestionsApi } from '../services/api';
 
 export default function DailyCheckin() {
   const { notify: originalNotify } = useToast();
@@ -18,6 +18,10 @@ export default function DailyCheckin() {
     notify.current = originalNotify;
   }, [originalNotify]);
 
+  // Stops analysis polling once the page is left
+  const mounted = useRef(true);
+  useEffect(() => () => { mounted.current = false; }, []);
+
   // State...
   const [questions, setQuestions] = useState([]);
   const [questionVersion, setQuestionVersion] = useState('');
@@ -202,12 +206,26 @@ export default function DailyCheckin() {
         question_version: questionVersion,
       };
 
-      await analyzeCheckinApi(payload);
+      const { checkin_id } = await analyzeCheckinApi(payload);
 
-      notify.current('Daily check-in saved with AI analysis!', 'success');
+      notify.current('Daily check-in saved! AI analysis is running in the background.', 'success');
       setSubmittedToday(true);
       await checkSubmittedToday(userId);
-      // loadHistory intentionally not called here
+
+      // The analysis is queued server-side: poll for it, then refresh the
+      // analysis panel and the risk/trend widgets
+      if (checkin_id) {
+        waitForCheckinAnalysis(checkin_id, { isCancelled: () => !mounted.current })
+          .then(async ({ status }) => {
+            if (!mounted.current) return;
+            if (status === 'failed') {
+              notify.current('AI analysis could not be completed for this check-in.', 'warning');
+            }
+            await checkSubmittedToday(userId);
+            await loadHistory(userId);
+          })
+          .catch(err => console.error('[DailyCheckin] analysis polling error:', err));
+      }
     } catch (err) {
       console.error('[DailyCheckin] Submit error:', err);
       const msg = err?.message || 'Failed to save check-in. Please try again.';
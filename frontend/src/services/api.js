@@ -147,7 +147,7 @@ export function processReportWithProgress(file, { onProgress, signal } = {}) {
   });
 }
 
-// ✅ UPDATED: Now uses LLM analysis from daily_checkins.llm_analysis
+// ✅ UPDATED: Saves the check-in and queues LLM analysis → { checkin_id, status: 'pending' }
 export async function analyzeCheckinApi(payload) {
   return jsonFetch(`${BASE}/functions/analyzeCheckin`, {
     method: 'POST',
@@ -155,6 +155,21 @@ export async function analyzeCheckinApi(payload) {
   });
 }
 
+// ✅ NEW: Poll a queued check-in analysis → { status: 'pending' | 'complete' | 'failed', analysis }
+export async function fetchCheckinAnalysis(checkinId) {
+  return jsonFetch(`${BASE}/functions/checkin/${checkinId}/analysis`);
+}
+
+// ✅ NEW: Poll until the analysis settles → resolves with the final { status, analysis }
+// (the server reports a lost analysis as 'failed', so this always ends)
+export async function waitForCheckinAnalysis(checkinId, { intervalMs = 2000, isCancelled = () => false } = {}) {
+  for (;;) {
+    const result = await fetchCheckinAnalysis(checkinId);
+    if (result.status !== 'pending' || isCancelled()) return result;
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+}
+
 export async function findNearbyAmbulance(lat, lng, radiusMeters = 5000) {
   const url = new URL(`${BASE}/functions/findNearbyAmbulance`);
   url.searchParams.set('lat', String(lat));
@@ -265,6 +280,8 @@ export const api = {
   processReport,
   processReportWithProgress,
   analyzeCheckinApi,
+  fetchCheckinAnalysis,
+  waitForCheckinAnalysis,
   
   // LLM Features
   ...llmApi,